@@ -1,97 +1,156 @@
+import atexit
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
-from datetime import datetime
 import time
 
 class CustomFormatter(logging.Formatter):
+    # (second, datefmt, formatted) for the last formatted record; records logged
+    # within the same second reuse the prefix and only add the milliseconds.
+    _ts_cache = (0, None, '')
+
     def __init__(self):
         # Tell formatter to extract caller info
         super().__init__(style='{')
         self._fmt = "%(asctime)s | %(levelname)-8s | %(module)s:%(lineno)-4d | %(message)s"
-        self.datefmt = '%H:%M:%S.%f'
+        self.datefmt = '%H:%M:%S'
+        self.default_msec_format = '%s.%03d'
+
+        # Padded level labels keyed by the integer levelno
+        self._level_labels = {
+            levelno: f"{logging.getLevelName(levelno):<8}"
+            for levelno in (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL)
+        }
+
+        # Per event type: the full line template plus optional trailers, of
+        # which the first whose field is set on the record gets appended
+        header = "{ts} | {level} | {module}:{lineno:<4} | {event_type:<10} | {sender:<10}"
+        self._templates = {
+            'MESSAGE': (
+                header + " | {content_type}",
+                (('content', " | | {content}"),),
+            ),
+            'TOOL_USE': (
+                header + " | {tool_name:<10} | | {command}",
+                (),
+            ),
+            'TOOL_RESULT': (
+                header + " | {result_type:<10}",
+                (('error', " | | Error: {error}"), ('output', " | | output: {output}")),
+            ),
+        }
 
     def formatTime(self, record, datefmt=None):
         # Only show time, not date
-        ct = self.converter(record.created)
-        if datefmt:
-            s = time.strftime(datefmt, ct)
-            return s[:-3]  # Trim microseconds to 3 digits
-        else:
-            return time.strftime('%H:%M:%S', ct)
+        datefmt = datefmt or self.datefmt
+        sec = int(record.created)
+        if (sec, datefmt) != self._ts_cache[:2]:
+            self._ts_cache = (sec, datefmt, time.strftime(datefmt, self.converter(sec)))
+        return self.default_msec_format % (self._ts_cache[2], record.msecs)
 
     def format(self, record):
-        # Get the original caller's info
-        if record.name == "logger":
-            # Walk up the stack to find the real caller
-            frame = logging.currentframe()
-            while frame and frame.f_code.co_filename.endswith("logger.py"):
-                frame = frame.f_back
-            if frame:
-                record.lineno = frame.f_lineno
-                record.module = frame.f_code.co_filename.split("/")[-1].split(".")[0]
-
-        # Format based on event type
-        if hasattr(record, 'event_type'):
-            message_parts = [
-                f"{self.formatTime(record, self.datefmt)}",
-                f"{record.levelname:<8}",
-                f"{record.module}:{record.lineno:<4}",
-                f"{record.event_type:<10}",
-                f"{record.sender:<10}"
-            ]
-
-            if record.event_type == 'MESSAGE':
-                message_parts.append(f"{record.content_type}")
-                if hasattr(record, 'content'):
-                    message_parts.append(f"| {record.content}")
-            elif record.event_type == 'TOOL_USE':
-                message_parts.extend([f"{record.tool_name:<10}", f"| {record.command}"])
-            elif record.event_type == 'TOOL_RESULT':
-                message_parts.append(f"{record.result_type:<10}")
-                if hasattr(record, 'error'):
-                    message_parts.append(f"| Error: {record.error}")
-                elif hasattr(record, 'output'):
-                    message_parts.append(f"| output: {record.output}")
-
-            return " | ".join(message_parts)
+        # Format based on event type; `extra` fields live directly in the record's __dict__
+        d = record.__dict__
+        layout = self._templates.get(d.get('event_type'))
+        if layout is not None:
+            template, trailers = layout
+            level = self._level_labels.get(record.levelno) or f"{record.levelname:<8}"
+            fields = d | {'ts': self.formatTime(record, self.datefmt), 'level': level}
+            text = template.format_map(fields)
+            for field, trailer in trailers:
+                if field in d:
+                    return text + trailer.format_map(fields)
+            return text
 
         return super().format(record)
 
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """
+    A size-rotated log file that leaves flushing to a large write buffer instead of
+    flushing after every record. ERROR and above are still flushed immediately.
+    """
+
+    def __init__(self, filename, maxBytes=0, backupCount=0, encoding=None, buffer_size=64 * 1024):
+        self.buffer_size = buffer_size
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount, encoding=encoding)
+        # Track the file size ourselves; RotatingFileHandler.shouldRollover
+        # formats every record a second time and seeks the stream
+        self._written = self.stream.tell()
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=self.buffer_size, encoding=self.encoding, errors=self.errors)
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + self.terminator
+            if self.maxBytes > 0 and self._written + len(msg) > self.maxBytes:
+                self.doRollover()
+                self._written = 0
+            self.stream.write(msg)
+            self._written += len(msg)
+            if record.levelno >= logging.ERROR:
+                self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
 def setup_logger():
     logger = logging.getLogger(__name__)
+    if logger.handlers:
+        # Already configured, e.g. when this module is reloaded on a rerun;
+        # installing a second set of handlers would write every record twice
+        return logger
     logger.setLevel(logging.DEBUG)
+    logger.propagate = False
 
     # Create logs directory if it doesn't exist
     log_dir = Path("logs")
     log_dir.mkdir(exist_ok=True)
 
-    # Create a daily rotating file handler with date in filename
-    file_handler = TimedRotatingFileHandler(
+    # Create a buffered, size-rotated file handler
+    file_handler = BufferedRotatingFileHandler(
         filename=log_dir / "mac_computer_use.log",
-        when="midnight",
-        interval=1,
-        backupCount=7,  # Keep logs for 7 days
+        maxBytes=10 * 1024 * 1024,
+        backupCount=7,
         encoding="utf-8"
     )
-    # Customize the suffix to include date
-    file_handler.suffix = "%Y-%m-%d.log"
-    
+
     # Set formatter
     formatter = CustomFormatter()
     file_handler.setFormatter(formatter)
     
-    # Add handler to logger
-    logger.addHandler(file_handler)
+    # Hand records to a background listener so callers only pay for an enqueue;
+    # formatting and disk writes happen off the agent loop's thread
+    log_queue = queue.Queue(-1)
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
     
     return logger
 
 # Create logger instance
 logger = setup_logger()
 
+# Longest value a helper passes through to a record field; tool outputs can be
+# arbitrarily large and the log only needs enough to identify what happened
+_MAX_LOG_FIELD = 4096
+
+def _clip(value: str) -> str:
+    if len(value) <= _MAX_LOG_FIELD:
+        return value
+    return f"{value[:_MAX_LOG_FIELD]}...[+{len(value) - _MAX_LOG_FIELD} chars]"
+
 def log_tool_use(sender: str, tool_name: str, command: str):
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    command = _clip(command)
     logger.debug(
-        "",
+        "%s",
+        command,
+        stacklevel=2,
         extra={
             'event_type': 'TOOL_USE',
             'sender': sender,
@@ -101,53 +160,27 @@ def log_tool_use(sender: str, tool_name: str, command: str):
     )
 
 def log_tool_result(sender: str, tool_type: str, output: str = None, error: str = None):
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    extra = {
+        'event_type': 'TOOL_RESULT',
+        'sender': sender,
+        'result_type': tool_type
+    }
     if error:
-        logger.debug(
-            "",
-            extra={
-                'event_type': 'TOOL_RESULT',
-                'sender': sender,
-                'result_type': tool_type,
-                'error': error
-            }
-        )
+        extra['error'] = _clip(error)
     elif output:
-        logger.debug(
-            "",
-            extra={
-                'event_type': 'TOOL_RESULT',
-                'sender': sender,
-                'result_type': tool_type,
-                'output': output
-            }
-        )
-    else:
-        logger.debug(
-            "",
-            extra={
-                'event_type': 'TOOL_RESULT',
-                'sender': sender,
-                'result_type': tool_type
-            }
-        )
+        extra['output'] = _clip(output)
+    logger.debug("%s", tool_type, stacklevel=2, extra=extra)
 
 def log_message(sender: str, message_type: str, content: str = None):
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    extra = {
+        'event_type': 'MESSAGE',
+        'sender': sender,
+        'content_type': message_type
+    }
     if content:
-        logger.debug(
-            "",
-            extra={
-                'event_type': 'MESSAGE',
-                'sender': sender,
-                'content_type': message_type,
-                'content': content
-            }
-        )
-    else:
-        logger.debug(
-            "",
-            extra={
-                'event_type': 'MESSAGE',
-                'sender': sender,
-                'content_type': message_type
-            }
-        )
\ No newline at end of file
+        extra['content'] = _clip(content)
+    logger.debug("%s", message_type, stacklevel=2, extra=extra)
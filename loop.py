@@ -2,14 +2,21 @@
 Agentic sampling loop that calls the Anthropic API and local implementation of anthropic-defined computer use tools.
 """
 
+import asyncio
+import atexit
+import hashlib
 import platform
+import random
+import time
+from collections import deque
 from collections.abc import Callable
 from datetime import datetime
 from enum import StrEnum
+from pathlib import Path
 from typing import Any, cast, Union, Literal, TypedDict
-import httpx
 
 import httpx
+import orjson
 from anthropic import (
     Anthropic,
     AnthropicBedrock,
@@ -17,6 +24,7 @@ from anthropic import (
     APIError,
     APIResponseValidationError,
     APIStatusError,
+    RateLimitError,
 )
 from anthropic.types.beta import (
     BetaCacheControlEphemeralParam,
@@ -30,11 +38,42 @@ from anthropic.types.beta import (
     BetaToolUseBlockParam,
 )
 
-from tools import BashTool, ComputerTool, EditTool, ToolCollection, ToolResult
+from tools import (
+    BashTool,
+    ComputerTool,
+    EditTool,
+    ToolCollection,
+    ToolFailure,
+    ToolResult,
+)
 
 COMPUTER_USE_BETA_FLAG = "computer-use-2024-10-22"
 PROMPT_CACHING_BETA_FLAG = "prompt-caching-2024-07-31"
 
+# One connection pool for every sampling_loop call in the process, so keep-alive
+# connections to the API survive from one user message to the next
+_HTTP_CLIENT = httpx.Client(
+    limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+    timeout=httpx.Timeout(600.0, connect=10.0),
+)
+atexit.register(_HTTP_CLIENT.close)
+
+# Where sampling_loop(enable_response_cache=True) keeps responses, and for how long
+RESPONSE_CACHE_DIR = Path("/tmp/mac_cu_cache")
+RESPONSE_CACHE_TTL = 10 * 60  # seconds
+
+# A screenshot identical to one sent within this many messages is replaced by a
+# note pointing at the earlier tool_result
+IMAGE_DEDUP_WINDOW = 20
+
+# Smallest max_tokens a turn is sized down to from the running output average
+MIN_TURN_MAX_TOKENS = 512
+
+# Rate limits outlast the client's own short retries; back off further, in seconds
+RATE_LIMIT_RETRIES = 3
+RATE_LIMIT_BASE_DELAY = 30
+RATE_LIMIT_MAX_DELAY = 600
+
 
 class APIProvider(StrEnum):
     ANTHROPIC = "anthropic"
@@ -55,7 +94,7 @@ PROVIDER_TO_DEFAULT_MODEL_NAME: dict[APIProvider, str] = {
 # environment it is running in, and to provide any additional information that may be
 # helpful for the task at hand.
 
-SYSTEM_PROMPT = f"""
+SYSTEM_PROMPT = """
 <SYSTEM_DEFINITION>
 You are an AI assistant with access to a Mac computer through a web interface in Chrome.
 
@@ -83,7 +122,7 @@ Remember:
    - Architecture: x86_64
    - Internet: Active connection available
    - Time Zone: System configured
-   - Current Date: {datetime.today().strftime('%A, %B %-d, %Y')}
+   - Current Date: given at the end of this prompt
 
 <APPLICATION_ECOSYSTEM>
 1. Development Environment:
@@ -452,8 +491,8 @@ Remember:
 Important: Use macOS-compatible commands and flags:
 
 1. File Operations:
-   ✓ find . -name "*.txt" -exec stat -f "%Sm %N" {'{}'} \\;  # List files with timestamps
-   ✓ find . -type f -exec grep -l "pattern" {'{}'} \\;  # Find files containing pattern
+   ✓ find . -name "*.txt" -exec stat -f "%Sm %N" {} \\;  # List files with timestamps
+   ✓ find . -type f -exec grep -l "pattern" {} \\;  # Find files containing pattern
    ✓ stat -f "%Sm %N" file.txt  # Get file stats
    ✓ ls -lT  # Long listing with full timestamp
    × find . -printf  # Not available on macOS
@@ -462,7 +501,7 @@ Important: Use macOS-compatible commands and flags:
 2. Text Processing:
    ✓ grep -E "pattern"  # Extended regex
    ✓ sed -i '' 's/old/new/g'  # In-place edit with backup
-   ✓ awk '{{print $1}}'  # BSD awk
+   ✓ awk '{print $1}'  # BSD awk
    × grep -P  # Perl regex not available
    × sed -i without ''  # Requires empty backup arg
 
@@ -494,6 +533,52 @@ Remember:
 - Prefer built-in macOS commands when available
 """
 
+
+class ConversationState:
+    """
+    The message list plus indexes of its user turns and tool_result images, kept up
+    to date on append so per-turn passes don't rescan the whole conversation.
+    """
+
+    __slots__ = ("messages", "user_indices", "images")
+
+    def __init__(self, messages: list[BetaMessageParam]):
+        self.messages = messages
+        # positions of user messages with list content, the cache breakpoint candidates
+        self.user_indices: list[int] = []
+        # (tool_result block, image block) for every image still sent, oldest first
+        self.images: deque[tuple[BetaToolResultBlockParam, BetaImageBlockParam]] = deque()
+        for index, message in enumerate(messages):
+            self._track(index, message)
+
+    @property
+    def image_count(self) -> int:
+        return len(self.images)
+
+    def append(self, message: BetaMessageParam):
+        self.messages.append(message)
+        self._track(len(self.messages) - 1, message)
+
+    def _track(self, index: int, message: BetaMessageParam):
+        # tool_result blocks only appear in user messages, so assistant turns
+        # are never walked
+        content = message["content"]
+        if message["role"] != "user" or not isinstance(content, list):
+            return
+        self.user_indices.append(index)
+        # local aliases for the per-block loop
+        get = dict.get
+        add_image = self.images.append
+        for item in content:
+            if get(item, "type") != "tool_result":
+                continue
+            result_content = get(item, "content")
+            if isinstance(result_content, list):
+                for result_item in result_content:
+                    if get(result_item, "type") == "image":
+                        add_image((item, result_item))
+
+
 async def sampling_loop(
     *,
     model: str,
@@ -508,6 +593,10 @@ async def sampling_loop(
     api_key: str,
     only_n_most_recent_images: int | None = None,
     max_tokens: int = 4096,
+    batch_output_callback: Callable[[list[BetaContentBlockParam]], None] | None = None,
+    batch_tool_output_callback: Callable[[list[tuple[ToolResult, str]]], None]
+    | None = None,
+    enable_response_cache: bool = False,
 ):
     """
     Agentic sampling loop to call the assistant/tool interaction of computer use.
@@ -522,79 +611,168 @@ async def sampling_loop(
         api_response_callback: Callback for API responses
         api_key: API authentication key
         only_n_most_recent_images: Number of recent images to keep
-        max_tokens: Maximum tokens for response
+        max_tokens: Maximum tokens for response; turns ask for less once the typical
+            response length is known, and retry with the full budget if cut off
+        batch_output_callback: If set, called once per turn with all content
+            blocks instead of calling output_callback per block
+        batch_tool_output_callback: If set, called once per turn with all
+            (result, tool_use_id) pairs instead of calling tool_output_callback
+            per result
+        enable_response_cache: Replay the stored response for a request identical
+            to one made within RESPONSE_CACHE_TTL instead of calling the API
     """
     tool_collection = ToolCollection(
         ComputerTool(),
         BashTool(),
         EditTool(),
     )
-    system = BetaTextBlockParam(
-        type="text",
-        text=f"{SYSTEM_PROMPT}{' ' + system_prompt_suffix if system_prompt_suffix else ''}"
-    )
+    system = BetaTextBlockParam(type="text", text=SYSTEM_PROMPT)
+    # The date changes daily and the suffix per user, so both go in their own
+    # blocks after the cache breakpoint on the static prompt rather than
+    # invalidating it whenever they change
+    system_blocks: list[BetaTextBlockParam] = [
+        system,
+        BetaTextBlockParam(
+            type="text",
+            text=f"Current Date: {datetime.today().strftime('%A, %B %-d, %Y')}",
+        ),
+    ]
+    if system_prompt_suffix:
+        system_blocks.append(BetaTextBlockParam(type="text", text=system_prompt_suffix))
+
+    # Build the client once; it shares the process-wide connection pool
+    enable_prompt_caching = False
+    if provider == APIProvider.ANTHROPIC:
+        client = Anthropic(api_key=api_key, max_retries=4, http_client=_HTTP_CLIENT)
+        enable_prompt_caching = True
+    elif provider == APIProvider.VERTEX:
+        client = AnthropicVertex(http_client=_HTTP_CLIENT)
+    elif provider == APIProvider.BEDROCK:
+        client = AnthropicBedrock(http_client=_HTTP_CLIENT)
+    else:
+        raise ValueError(f"Unsupported provider: {provider}")
+
+    # the tool set and beta flags are fixed for the whole loop; tools come first
+    # in the cached prefix, so keep their order stable. The system breakpoint
+    # below already covers them, and all 4 breakpoints are spoken for.
+    tool_params = sorted(tool_collection.to_params(), key=lambda tool: tool["name"])
+    betas = [COMPUTER_USE_BETA_FLAG]
+    image_truncation_threshold = only_n_most_recent_images or 0
+    if enable_prompt_caching:
+        betas.append(PROMPT_CACHING_BETA_FLAG)
+        # Because cached reads are 10% of the price, we don't think it's
+        # ever sensible to break the cache by truncating images
+        only_n_most_recent_images = 0
+        system["cache_control"] = {"type": "ephemeral"}
+    state = ConversationState(messages)
+    # caps how many tool calls from one turn run at the same time
+    tool_semaphore = asyncio.Semaphore(4)
+    # image hash -> (tool_use_id, message position) of the last copy actually sent
+    seen_images: dict[bytes, tuple[str, int]] = {}
+    # running average of output tokens per response, used to size max_tokens
+    output_tokens_ema: float | None = None
 
-    # Initialize client with a default value
-    client = None  # Add at start of function
     while True:
-        if provider == APIProvider.ANTHROPIC:
-            client = Anthropic(api_key=api_key, max_retries=4, http_client=httpx.Client())
-            enable_prompt_caching = True
-        elif provider == APIProvider.VERTEX:
-            client = AnthropicVertex()
-        elif provider == APIProvider.BEDROCK:
-            client = AnthropicBedrock()
-        else:
-            raise ValueError(f"Unsupported provider: {provider}")
-
-        if client is None:
-            raise RuntimeError("Failed to initialize client")
-
-        betas = [COMPUTER_USE_BETA_FLAG]
-        image_truncation_threshold = only_n_most_recent_images or 0
         if enable_prompt_caching:
-            betas.append(PROMPT_CACHING_BETA_FLAG)
-            _inject_prompt_caching(messages)
-            # Because cached reads are 10% of the price, we don't think it's
-            # ever sensible to break the cache by truncating images
-            only_n_most_recent_images = 0
-            system["cache_control"] = {"type": "ephemeral"}
+            _inject_prompt_caching(state)
 
         if only_n_most_recent_images:
             _maybe_filter_to_n_most_recent_images(
-                messages,
+                state,
                 only_n_most_recent_images,
                 min_removal_threshold=image_truncation_threshold,
             )
 
-        # Call the API
-        # we use raw_response to provide debug information to streamlit. Your
-        # implementation may be able call the SDK directly with:
-        # `response = client.messages.create(...)` instead.
-        try:
-            raw_response = client.beta.messages.with_raw_response.create(
-                max_tokens=max_tokens,
-                messages=messages,
-                model=model,
-                system=[system],
-                tools=tool_collection.to_params(),
-                betas=betas,
+        cache_key = None
+        response_params = None
+        if enable_response_cache:
+            # serializing the conversation and reading the disk both block, so do
+            # them in a worker thread rather than on the event loop
+            cache_key = await asyncio.to_thread(
+                _response_cache_key, model, max_tokens, system_blocks, tool_params, messages
             )
-        except (APIStatusError, APIResponseValidationError) as e:
-            api_response_callback(e.request, e.response, e)
-            return messages
-        except APIError as e:
-            api_response_callback(e.request, e.body, e)
-            return messages
-
-        api_response_callback(
-            raw_response.http_response.request, raw_response.http_response, None
-        )
-
-        response = raw_response.parse()
+            response_params = await asyncio.to_thread(_load_cached_response, cache_key)
+
+        # tool_use blocks start running as soon as they are complete, while the
+        # rest of the response is still being generated
+        tool_runner = _ToolRunner(tool_collection, tool_semaphore)
+        if response_params is None:
+            # Most turns are short tool calls, so ask for about twice the recent
+            # average output rather than reserving the full budget every time
+            turn_max_tokens = max_tokens
+            if output_tokens_ema is not None:
+                turn_max_tokens = min(
+                    max_tokens, max(MIN_TURN_MAX_TOKENS, int(output_tokens_ema * 2) + 256)
+                )
+            # Call the API
+            # The SDK stream is synchronous, so run it in a worker thread to keep the
+            # event loop free; finished tool_use blocks are handed back to it.
+            event_loop = asyncio.get_running_loop()
+            rate_limit_retries = 0
+            while True:
+                try:
+                    http_response, response = await asyncio.to_thread(
+                        _stream_message,
+                        client,
+                        lambda block: event_loop.call_soon_threadsafe(
+                            tool_runner.submit, block
+                        ),
+                        max_tokens=turn_max_tokens,
+                        messages=messages,
+                        model=model,
+                        system=system_blocks,
+                        tools=tool_params,
+                        betas=betas,
+                    )
+                except RateLimitError as e:
+                    api_response_callback(e.request, e.response, e)
+                    if rate_limit_retries < RATE_LIMIT_RETRIES and not tool_runner.tool_use_ids:
+                        await asyncio.sleep(_rate_limit_delay(e, rate_limit_retries))
+                        rate_limit_retries += 1
+                        continue
+                    await tool_runner.results()
+                    return messages
+                except (APIStatusError, APIResponseValidationError) as e:
+                    await tool_runner.results()
+                    api_response_callback(e.request, e.response, e)
+                    return messages
+                except APIError as e:
+                    await tool_runner.results()
+                    api_response_callback(e.request, e.body, e)
+                    return messages
+
+                api_response_callback(http_response.request, http_response, None)
+
+                output_tokens = response.usage.output_tokens
+                output_tokens_ema = (
+                    output_tokens
+                    if output_tokens_ema is None
+                    else 0.8 * output_tokens_ema + 0.2 * output_tokens
+                )
+                if response.stop_reason != "max_tokens" or turn_max_tokens >= max_tokens:
+                    break
+                if tool_runner.tool_use_ids:
+                    # tools are already running; keep the response up to the last
+                    # complete tool_use rather than asking again and repeating them
+                    break
+                turn_max_tokens = max_tokens
+                tool_runner = _ToolRunner(tool_collection, tool_semaphore)
+
+            response_params = _response_to_params(response)
+            if response.stop_reason == "max_tokens" and tool_runner.tool_use_ids:
+                last_id = tool_runner.tool_use_ids[-1]
+                for index, content_block in enumerate(response_params):
+                    if content_block.get("id") == last_id:
+                        del response_params[index + 1 :]
+                        break
+            if cache_key is not None:
+                await asyncio.to_thread(_store_cached_response, cache_key, response_params)
+        else:
+            for content_block in response_params:
+                if content_block["type"] == "tool_use":
+                    tool_runner.submit(cast(BetaToolUseBlockParam, content_block))
 
-        response_params = _response_to_params(response)
-        messages.append(
+        state.append(
             {
                 "role": "assistant",
                 "content": response_params,
@@ -602,26 +780,119 @@ async def sampling_loop(
         )
 
         tool_result_content: list[BetaToolResultBlockParam] = []
+        tool_use_blocks: list[BetaToolUseBlockParam] = []
+        add_tool_use = tool_use_blocks.append
         for content_block in response_params:
-            output_callback(content_block)
+            if batch_output_callback is None:
+                output_callback(content_block)
             if content_block["type"] == "tool_use":
-                result = await tool_collection.run(
-                    name=content_block["name"],
-                    tool_input=cast(dict[str, Any], content_block["input"]),
-                )
-                tool_result_content.append(
-                    _make_api_tool_result(result, content_block["id"])
+                add_tool_use(cast(BetaToolUseBlockParam, content_block))
+        if batch_output_callback is not None:
+            batch_output_callback(response_params)
+
+        # local aliases for the per-block loop
+        add_tool_result = tool_result_content.append
+        make_tool_result = _make_api_tool_result
+        # submitted in block order, so results line up with tool_use_blocks
+        results = await tool_runner.results()
+        tool_outputs: list[tuple[ToolResult, str]] = []
+        for content_block, result in zip(tool_use_blocks, results):
+            tool_use_id = content_block["id"]
+            duplicate_of = None
+            # Truncation could drop the earlier copy a note points at, so only
+            # dedupe when every image is kept
+            if not only_n_most_recent_images:
+                duplicate_of = _find_duplicate_image(
+                    result, tool_use_id, seen_images, len(messages)
                 )
-                tool_output_callback(result, content_block["id"])
+            add_tool_result(make_tool_result(result, tool_use_id, duplicate_of))
+            if batch_tool_output_callback is None:
+                tool_output_callback(result, tool_use_id)
+            else:
+                tool_outputs.append((result, tool_use_id))
+        if batch_tool_output_callback is not None and tool_outputs:
+            batch_tool_output_callback(tool_outputs)
 
         if not tool_result_content:
             return messages
 
-        messages.append({"content": tool_result_content, "role": "user"})
+        state.append({"content": tool_result_content, "role": "user"})
+
+
+def _rate_limit_delay(error: RateLimitError, attempt: int) -> float:
+    """
+    Seconds to wait before retrying a rate limited request: the server's
+    retry-after when it sends one, otherwise exponential backoff with jitter.
+    """
+    retry_after = error.response.headers.get("retry-after")
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), RATE_LIMIT_MAX_DELAY)
+        except ValueError:
+            pass
+    delay = min(RATE_LIMIT_BASE_DELAY * 2**attempt, RATE_LIMIT_MAX_DELAY)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _stream_message(
+    client: Anthropic | AnthropicVertex | AnthropicBedrock,
+    on_tool_use: Callable[[BetaToolUseBlockParam], None],
+    **request: Any,
+) -> tuple[httpx.Response, BetaMessage]:
+    """
+    Stream one response, calling on_tool_use with each tool_use block as soon as its
+    input has finished streaming. Blocks until the response is complete.
+    """
+    with client.beta.messages.stream(**request) as stream:
+        for event in stream:
+            if event.type == "content_block_stop" and event.content_block.type == "tool_use":
+                on_tool_use(cast(BetaToolUseBlockParam, event.content_block.model_dump()))
+        return stream.response, stream.get_final_message()
+
+
+class _ToolRunner:
+    """
+    Runs the tool_use blocks of one assistant turn as they are submitted, returning
+    results in submission order. Calls to different tools run concurrently; calls to
+    the same tool run in order, since they share state such as the bash session. A
+    call that raises is reported as a ToolFailure so it doesn't abandon the calls
+    still in flight. At most as many calls as the semaphore allows run at once.
+    """
+
+    def __init__(self, tool_collection: ToolCollection, semaphore: asyncio.Semaphore):
+        self.tool_collection = tool_collection
+        self.semaphore = semaphore
+        self.tool_use_ids: list[str] = []
+        self._tasks: list[asyncio.Task[ToolResult]] = []
+        self._last_task_by_tool: dict[str, asyncio.Task[ToolResult]] = {}
+
+    def submit(self, block: BetaToolUseBlockParam):
+        self.tool_use_ids.append(block["id"])
+        previous = self._last_task_by_tool.get(block["name"])
+        task = asyncio.create_task(self._run(block, previous))
+        self._last_task_by_tool[block["name"]] = task
+        self._tasks.append(task)
+
+    async def _run(
+        self, block: BetaToolUseBlockParam, previous: asyncio.Task[ToolResult] | None
+    ) -> ToolResult:
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            async with self.semaphore:
+                return await self.tool_collection.run(
+                    name=block["name"],
+                    tool_input=cast(dict[str, Any], block["input"]),
+                )
+        except Exception as e:
+            return ToolFailure(error=f"{type(e).__name__}: {e}")
+
+    async def results(self) -> list[ToolResult]:
+        return list(await asyncio.gather(*self._tasks))
 
 
 def _maybe_filter_to_n_most_recent_images(
-    messages: list[BetaMessageParam],
+    state: ConversationState,
     images_to_keep: int,
     min_removal_threshold: int,
 ):
@@ -631,42 +902,77 @@ def _maybe_filter_to_n_most_recent_images(
     images in place, with a chunk of min_removal_threshold to reduce the amount we
     break the implicit prompt cache.
     """
-    if not messages or images_to_keep < 0:
-        return messages
-
-    tool_result_blocks = cast(
-        list[BetaToolResultBlockParam],
-        [
-            item
-            for message in messages
-            for item in (
-                message["content"] if isinstance(message["content"], list) else []
-            )
-            if isinstance(item, dict) and item.get("type") == "tool_result"
-        ],
-    )
+    if images_to_keep < 0:
+        return
 
-    total_images = sum(
-        1
-        for tool_result in tool_result_blocks
-        for content in tool_result.get("content", [])
-        if isinstance(content, dict) and content.get("type") == "image"
+    images_to_remove = state.image_count - images_to_keep
+    # for better cache behavior, we want to remove in chunks
+    if min_removal_threshold > 0:
+        images_to_remove -= images_to_remove % min_removal_threshold
+    if images_to_remove <= 0:
+        return
+
+    # pop the oldest images off the index, then rebuild only the blocks they sat in
+    dropped: dict[int, tuple[BetaToolResultBlockParam, set[int]]] = {}
+    images = state.images
+    for _ in range(min(images_to_remove, len(images))):
+        tool_result, image = images.popleft()
+        dropped.setdefault(id(tool_result), (tool_result, set()))[1].add(id(image))
+    for tool_result, image_ids in dropped.values():
+        # edit the list in place: cache breakpoint injection may have replaced the
+        # tool_result with a shallow copy that shares it
+        content = tool_result["content"]
+        content[:] = [item for item in content if id(item) not in image_ids]
+
+
+def _response_cache_key(
+    model: str,
+    max_tokens: int,
+    system: list[BetaTextBlockParam],
+    tools: list,
+    messages: list[BetaMessageParam],
+) -> str:
+    """Hash everything that determines a response into a response cache key."""
+    request = orjson.dumps(
+        {
+            "model": model,
+            "max_tokens": max_tokens,
+            "system": system,
+            "tools": tools,
+            "messages": messages,
+        },
+        option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS,
+        default=str,
     )
+    return hashlib.blake2b(request, digest_size=16).hexdigest()
 
-    images_to_remove = total_images - images_to_keep
-    # for better cache behavior, we want to remove in chunks
-    images_to_remove -= images_to_remove % min_removal_threshold
-
-    for tool_result in tool_result_blocks:
-        if isinstance(tool_result.get("content"), list):
-            new_content = []
-            for content in tool_result.get("content", []):
-                if isinstance(content, dict) and content.get("type") == "image":
-                    if images_to_remove > 0:
-                        images_to_remove -= 1
-                        continue
-                new_content.append(content)
-            tool_result["content"] = new_content
+
+def _load_cached_response(
+    key: str,
+) -> list[BetaTextBlockParam | BetaToolUseBlockParam] | None:
+    """Return the stored response params for `key`, unless missing or expired."""
+    path = RESPONSE_CACHE_DIR / f"{key}.json"
+    try:
+        if time.time() - path.stat().st_mtime > RESPONSE_CACHE_TTL:
+            path.unlink(missing_ok=True)
+            return None
+        return orjson.loads(path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+
+def _store_cached_response(
+    key: str, response_params: list[BetaTextBlockParam | BetaToolUseBlockParam]
+):
+    """Store response params under `key`; a failed write just means no caching."""
+    try:
+        RESPONSE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        path = RESPONSE_CACHE_DIR / f"{key}.json"
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(orjson.dumps(response_params, default=str))
+        tmp_path.replace(path)
+    except (OSError, orjson.JSONEncodeError):
+        pass
 
 
 def _response_to_params(
@@ -682,63 +988,107 @@ def _response_to_params(
 
 
 def _inject_prompt_caching(
-    messages: list[BetaMessageParam],
+    state: ConversationState,
 ):
     """
     Set cache breakpoints for the 3 most recent turns
     one cache breakpoint is left for tools/system prompt, to be shared across sessions
     """
     breakpoints_remaining = 3
-    for message in reversed(messages):
-        if message["role"] == "user" and isinstance(
-            content := message["content"], list
-        ):
-            if breakpoints_remaining and content:  # Check if content is not empty
-                breakpoints_remaining -= 1
-                last_content = content[-1]
-                if isinstance(last_content, dict):
-                    # Create properly typed cache control
-                    cache_control: BetaCacheControlEphemeralParam = {"type": "ephemeral"}
-                    last_content["cache_control"] = cache_control
-            else:
-                if content and isinstance(content[-1], dict):
-                    content[-1].pop("cache_control", None)
-                break
+    messages = state.messages
+    # only user messages with list content matter, and the walk stops at the 4th
+    for index in reversed(state.user_indices):
+        content = messages[index]["content"]
+        # Blocks are replaced by shallow copies rather than edited in place, so a
+        # block object never changes once it has been sent
+        if breakpoints_remaining and content:  # Check if content is not empty
+            breakpoints_remaining -= 1
+            last_content = content[-1]
+            if isinstance(last_content, dict) and "cache_control" not in last_content:
+                # Create properly typed cache control
+                cache_control: BetaCacheControlEphemeralParam = {"type": "ephemeral"}
+                content[-1] = {**last_content, "cache_control": cache_control}
+        else:
+            last_content = content[-1] if content else None
+            if isinstance(last_content, dict) and "cache_control" in last_content:
+                content[-1] = {
+                    key: value
+                    for key, value in last_content.items()
+                    if key != "cache_control"
+                }
+            break
+
+
+def _find_duplicate_image(
+    result: ToolResult,
+    tool_use_id: str,
+    seen_images: dict[bytes, tuple[str, int]],
+    position: int,
+) -> str | None:
+    """
+    Return the tool_use_id of an identical image sent within IMAGE_DEDUP_WINDOW
+    messages of `position`, otherwise record this result's image as the latest copy.
+    """
+    if result.error or not result.base64_image:
+        return None
+    image_hash = hashlib.blake2b(result.base64_image.encode(), digest_size=8).digest()
+    seen = seen_images.get(image_hash)
+    if seen is not None and position - seen[1] <= IMAGE_DEDUP_WINDOW:
+        return seen[0]
+    seen_images[image_hash] = (tool_use_id, position)
+    return None
 
 
 def _make_api_tool_result(
-    result: ToolResult, tool_use_id: str
+    result: ToolResult, tool_use_id: str, duplicate_image_of: str | None = None
 ) -> BetaToolResultBlockParam:
-    """Convert an agent ToolResult to an API ToolResultBlockParam."""
-    tool_result_content: list[BetaTextBlockParam | BetaImageBlockParam] | str = []
-    is_error = False
+    """
+    Convert an agent ToolResult to an API ToolResultBlockParam. If
+    `duplicate_image_of` is set, the image is replaced by a note referring to
+    that earlier tool_result.
+    """
     if result.error:
-        is_error = True
-        tool_result_content = _maybe_prepend_system_tool_result(result, result.error)
-    else:
-        if result.output:
-            tool_result_content.append(
-                {
-                    "type": "text",
-                    "text": _maybe_prepend_system_tool_result(result, result.output),
-                }
-            )
-        if result.base64_image:
-            tool_result_content.append(
-                {
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/png",
-                        "data": result.base64_image,
-                    },
-                }
-            )
+        return {
+            "type": "tool_result",
+            "content": _maybe_prepend_system_tool_result(result, result.error)
+            if result.system
+            else result.error,
+            "tool_use_id": tool_use_id,
+            "is_error": True,
+        }
+
+    tool_result_content: list[BetaTextBlockParam | BetaImageBlockParam] = []
+    if result.output:
+        tool_result_content.append(
+            {
+                "type": "text",
+                "text": _maybe_prepend_system_tool_result(result, result.output)
+                if result.system
+                else result.output,
+            }
+        )
+    if result.base64_image and duplicate_image_of:
+        tool_result_content.append(
+            {
+                "type": "text",
+                "text": f"[image identical to tool_result {duplicate_image_of}]",
+            }
+        )
+    elif result.base64_image:
+        tool_result_content.append(_image_block(result.base64_image))
     return {
         "type": "tool_result",
         "content": tool_result_content,
         "tool_use_id": tool_use_id,
-        "is_error": is_error,
+        "is_error": False,
+    }
+
+
+def _image_block(data: str) -> BetaImageBlockParam:
+    """Wrap base64 PNG data in an API image block."""
+    return {
+        "type": "image",
+        "source": {"type": "base64", "media_type": "image/png", "data": data},
     }
 
 
@@ -4,22 +4,26 @@ Entrypoint for streamlit, see https://docs.streamlit.io/
 
 import asyncio
 import base64
+import itertools
 import os
-import subprocess
+import re
 import time
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from enum import StrEnum
-from functools import partial, wraps
+from functools import lru_cache, partial, wraps
+from io import BytesIO
 from pathlib import PosixPath
-from typing import cast, Any
+from typing import cast, Any, Callable, NamedTuple
 import json
 from contextlib import contextmanager
 import traceback
 from anthropic import RateLimitError
 
 import httpx
+import orjson
 import streamlit as st
-from streamlit.components.v1 import html
+from streamlit.components.v1 import declare_component, html
 from streamlit.delta_generator import DeltaGenerator
 from anthropic import APIResponse
 from anthropic.types import Message
@@ -32,13 +36,14 @@ from anthropic.types.beta import (
 )
 from anthropic.types.tool_use_block import ToolUseBlock
 from dotenv import load_dotenv
+from PIL import Image
 
 from loop import (
     PROVIDER_TO_DEFAULT_MODEL_NAME,
     APIProvider,
     sampling_loop,
 )
-from tools import ToolResult
+from tools import CLIResult, ToolFailure, ToolResult
 from logger import logger, log_tool_use, log_tool_result, log_message
 
 load_dotenv()
@@ -140,15 +145,18 @@ STREAMLIT_STYLE = """
         }, 500);
     }
     
-    // User controls toggle
+    // User controls toggle, bound only once however often this script runs
     let controlsEnabled = true;
-    document.addEventListener('keydown', (e) => {
-        if (e.key === ' ' && e.metaKey) {  // Space + Cmd
-            controlsEnabled = !controlsEnabled;
-            const event = new CustomEvent('controlsToggle', { detail: controlsEnabled });
-            window.dispatchEvent(event);
-        }
-    });
+    if (!window.streamlitControlsToggleBound) {
+        window.streamlitControlsToggleBound = true;
+        document.addEventListener('keydown', (e) => {
+            if (e.key === ' ' && e.metaKey) {  // Space + Cmd
+                controlsEnabled = !controlsEnabled;
+                const event = new CustomEvent('controlsToggle', { detail: controlsEnabled });
+                window.dispatchEvent(event);
+            }
+        });
+    }
     
     // Auto scroll
     function scrollToBottom() {
@@ -158,6 +166,16 @@ STREAMLIT_STYLE = """
         }
     }
     
+    // Keep the chat scrolled to the bottom as messages are added, instead of
+    // asking for a scroll from Python after every rerun
+    if (!window.streamlitScrollObserver) {
+        window.streamlitScrollObserver = new MutationObserver(scrollToBottom);
+        window.streamlitScrollObserver.observe(document.body, {
+            childList: true,
+            subtree: true
+        });
+    }
+    
     // Expose functions to Python
     window.streamlitFunctions = {
         updateMousePosition,
@@ -169,8 +187,55 @@ STREAMLIT_STYLE = """
 
 WARNING_TEXT = ""
 
+PROVIDER_OPTIONS = tuple(option.value for option in APIProvider)
+
 INTERRUPT_TEXT = "(user stopped or interrupted and wrote the following)"
 INTERRUPT_TOOL_ERROR = "human stopped or interrupted tool execution"
+# Most bytes of an HTTP request or response body kept for the logs tab
+LOG_BODY_LIMIT = 64 * 1024
+
+# Stored messages drawn on a rerun before older ones are folded away
+CHAT_HISTORY_WINDOW = 30
+# Results whose screenshot is kept in session state; older ones are text only
+MAX_STORED_TOOL_IMAGES = 50
+# Results kept at all; a dropped one renders as EVICTED_TOOL_RESULT
+MAX_STORED_TOOL_RESULTS = 500
+# Shown for a tool_result whose stored output is no longer available
+EVICTED_TOOL_RESULT = ToolResult(output="(tool output no longer available)")
+
+# Largest size screenshots are shown at in the chat
+THUMBNAIL_SIZE = (1024, 1024)
+
+# Tool result classes, matched by name when the tools module has been reloaded
+TOOL_RESULT_TYPE_NAMES = frozenset({"ToolResult", "CLIResult", "ToolFailure"})
+
+# Formatted tool_use blocks keyed by tool_use id, least recently used first
+_TOOL_USE_TEXT: OrderedDict[str, str] = OrderedDict()
+MAX_CACHED_TOOL_USE_TEXT = 1024
+
+# Text before, inside and after the first <thinking> section of a message
+THINKING_RE = re.compile(r"(.*?)<thinking>(.*?)</thinking>(.*)", re.DOTALL)
+
+# Mouse moves reported in tool output, e.g. "cliclick m:400,100"
+CLICLICK_MOVE_RE = re.compile(r"cliclick m:\s*(-?\d+),\s*(-?\d+)")
+
+# Long-lived component that mirrors mouse events onto the page's #mouse-tracker
+_mouse_overlay_component = declare_component(
+    "mouse_overlay",
+    path=str(PosixPath(__file__).parent / "components" / "mouse_overlay"),
+)
+
+
+class ApiExchange(NamedTuple):
+    """The display text of one HTTP exchange, formatted when it is recorded."""
+
+    request_headers: str
+    request_body: str
+    response_headers: str
+    response_body: str | None
+    # set when the body was cut at LOG_BODY_LIMIT and is no longer valid JSON
+    request_body_clipped: bool = False
+    response_body_clipped: bool = False
 
 
 class Sender(StrEnum):
@@ -199,8 +264,12 @@ def setup_state():
         st.session_state.auth_validated = False
     if "responses" not in st.session_state:
         st.session_state.responses = {}
+    if "response_counter" not in st.session_state:
+        st.session_state.response_counter = itertools.count(1)
     if "tools" not in st.session_state:
         st.session_state.tools = {}
+    if "tool_ids" not in st.session_state:
+        st.session_state.tool_ids = deque()
     if "only_n_most_recent_images" not in st.session_state:
         st.session_state.only_n_most_recent_images = 10
     if "custom_system_prompt" not in st.session_state:
@@ -209,6 +278,8 @@ def setup_state():
         st.session_state.hide_images = False
     if "controls_enabled" not in st.session_state:
         st.session_state.controls_enabled = True
+    if "mouse_event" not in st.session_state:
+        st.session_state.mouse_event = {"x": None, "y": None, "click": False, "seq": 0}
     if "in_sampling_loop" not in st.session_state:
         st.session_state.in_sampling_loop = False
 
@@ -227,7 +298,7 @@ async def main():
     """Render loop for streamlit"""
     setup_state()
 
-    st.markdown(STREAMLIT_STYLE, unsafe_allow_html=True)
+    st.markdown(PAGE_STYLE, unsafe_allow_html=True)
 
     st.title("Claude Computer Use for Mac")
 
@@ -239,10 +310,9 @@ async def main():
                 st.session_state.provider = st.session_state.provider_radio
                 st.session_state.auth_validated = False
 
-        provider_options = [option.value for option in APIProvider]
         st.radio(
             "API Provider",
-            options=provider_options,
+            options=PROVIDER_OPTIONS,
             key="provider_radio",
             format_func=lambda x: x.title(),
             on_change=_reset_api_provider,
@@ -256,7 +326,7 @@ async def main():
                 api_key_label,
                 type="password",
                 key="api_key",
-                on_change=lambda: save_to_storage("api_key", st.session_state.api_key),
+                on_change=lambda: save_setting("api_key", st.session_state.api_key),
             )
 
         st.number_input(
@@ -269,7 +339,7 @@ async def main():
             "Custom System Prompt Suffix",
             key="custom_system_prompt",
             help="Additional instructions to append to the system prompt. see computer_use_demo/loop.py for the base system prompt.",
-            on_change=lambda: save_to_storage(
+            on_change=lambda: save_setting(
                 "system_prompt", st.session_state.custom_system_prompt
             ),
         )
@@ -280,9 +350,17 @@ async def main():
                 st.session_state.clear()
                 setup_state()
 
-                subprocess.run("pkill Xvfb; pkill tint2", shell=True, check=True)  # noqa: ASYNC221
+                # run the shell commands without blocking the event loop; pkill
+                # exits non-zero when nothing matched, which is fine for a reset
+                proc = await asyncio.create_subprocess_shell(
+                    "pkill Xvfb; pkill tint2",
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.DEVNULL,
+                )
+                await proc.wait()
                 await asyncio.sleep(1)
-                subprocess.run("./start_all.sh", shell=True)  # noqa: ASYNC221
+                # start_all.sh keeps running in the background; don't wait on it
+                await asyncio.create_subprocess_shell("./start_all.sh")
 
     if not st.session_state.auth_validated:
         if auth_error := validate_auth(
@@ -294,6 +372,12 @@ async def main():
             st.session_state.auth_validated = True
 
     chat, http_logs = st.tabs(["Chat", "HTTP Exchange Logs"])
+    mouse_overlay = st.empty()
+    _render_mouse_overlay(mouse_overlay)
+
+    with http_logs:
+        # render past http exchanges
+        _render_http_logs()
     new_message = st.chat_input(
         "Type a message to send to Claude to control the computer..."
     )
@@ -303,26 +387,7 @@ async def main():
         chat_container = st.container()
         with chat_container:
             # render past chats
-            for message in st.session_state.messages:
-                if isinstance(message["content"], str):
-                    _render_message(message["role"], message["content"])
-                elif isinstance(message["content"], list):
-                    for block in message["content"]:
-                        if isinstance(block, dict) and block["type"] == "tool_result":
-                            _render_message(
-                                Sender.TOOL,
-                                st.session_state.tools[block["tool_use_id"]],
-                            )
-                        else:
-                            _render_message(
-                                message["role"],
-                                block,
-                            )
-
-            # render past http exchanges
-            for identity, response in st.session_state.responses.items():
-                if isinstance(response, httpx.Response):
-                    _render_api_response(response.request, response, identity, http_logs)
+            _render_chat_history()
 
             # render new message
             if new_message:
@@ -353,8 +418,16 @@ async def main():
                         provider=st.session_state.provider,
                         messages=st.session_state.messages,
                         output_callback=partial(_render_message, Sender.BOT),
+                        batch_output_callback=partial(_render_messages, Sender.BOT),
                         tool_output_callback=partial(
-                            _tool_output_callback, tool_state=st.session_state.tools
+                            _tool_output_callback,
+                            tool_state=st.session_state.tools,
+                            mouse_overlay=mouse_overlay,
+                        ),
+                        batch_tool_output_callback=partial(
+                            _tool_outputs_callback,
+                            tool_state=st.session_state.tools,
+                            mouse_overlay=mouse_overlay,
                         ),
                         api_response_callback=partial(
                             _api_response_callback,
@@ -364,13 +437,76 @@ async def main():
                         api_key=st.session_state.api_key,
                         only_n_most_recent_images=st.session_state.only_n_most_recent_images,
                     )
+                    if st.session_state.only_n_most_recent_images:
+                        _prune_old_images(
+                            st.session_state.messages,
+                            st.session_state.only_n_most_recent_images,
+                        )
 
-        # Auto scroll after rendering
-        html("""
-            <script>
-                window.streamlitFunctions.scrollToBottom();
-            </script>
-        """)
+
+def _prune_old_images(messages: list, images_to_keep: int):
+    """
+    Drop all but the last `images_to_keep` tool_result screenshots from the stored
+    conversation, so session state does not grow with every screenshot ever taken.
+    """
+    kept = 0
+    for message in reversed(messages):
+        if message["role"] != Sender.USER or not isinstance(message["content"], list):
+            continue
+        for block in reversed(message["content"]):
+            if not isinstance(block, dict) or block.get("type") != "tool_result":
+                continue
+            content = block.get("content")
+            if not isinstance(content, list):
+                continue
+            for i in range(len(content) - 1, -1, -1):
+                if content[i].get("type") != "image":
+                    continue
+                if kept >= images_to_keep:
+                    del content[i]
+                kept += 1
+
+
+@st.fragment
+def _render_chat_history():
+    """
+    Render the stored conversation. As a fragment, a rerun triggered from inside
+    it redraws only the history rather than the whole page. Only the last
+    CHAT_HISTORY_WINDOW messages are drawn unless the user asks for the rest.
+    """
+    tools = st.session_state.tools
+    messages = st.session_state.messages
+    hidden = len(messages) - CHAT_HISTORY_WINDOW
+    if hidden > 0 and not st.toggle(
+        f"Show {hidden} earlier messages", key="show_earlier_messages"
+    ):
+        messages = messages[hidden:]
+    for message in messages:
+        if isinstance(message["content"], str):
+            _render_message(message["role"], message["content"])
+        elif not isinstance(message["content"], list):
+            continue
+        elif message["role"] == Sender.BOT:
+            # an assistant turn never holds tool results; show it as one message
+            _render_messages(Sender.BOT, message["content"])
+        else:
+            for block in message["content"]:
+                if isinstance(block, dict) and block["type"] == "tool_result":
+                    _render_message(
+                        Sender.TOOL, tools.get(block["tool_use_id"], EVICTED_TOOL_RESULT)
+                    )
+                else:
+                    _render_message(message["role"], block)
+
+
+@st.fragment
+def _render_http_logs():
+    """
+    Render the stored HTTP exchanges. As a fragment, interacting with the logs
+    reruns only this tab rather than the whole page.
+    """
+    for identity, exchange in st.session_state.responses.items():
+        _render_api_exchange(exchange, identity)
 
 
 def validate_auth(provider: APIProvider, api_key: str | None):
@@ -379,120 +515,248 @@ def validate_auth(provider: APIProvider, api_key: str | None):
             key_type = "Anthropic API Key"
             return f"Enter your {key_type} in the sidebar to continue."
     if provider == APIProvider.BEDROCK:
-        import boto3
-
-        if not boto3.Session().get_credentials():
+        if not _has_bedrock_credentials():
             return "You must have AWS credentials set up to use the Bedrock API."
     if provider == APIProvider.VERTEX:
-        import google.auth
-        from google.auth.exceptions import DefaultCredentialsError
-
         if not os.environ.get("CLOUD_ML_REGION"):
             return "Set the CLOUD_ML_REGION environment variable to use the Vertex API."
-        try:
-            google.auth.default(
-                scopes=["https://www.googleapis.com/auth/cloud-platform"],
-            )
-        except DefaultCredentialsError:
+        if not _has_vertex_credentials():
             return "Your google cloud credentials are not set up correctly."
 
 
+# The credential probes import heavy SDKs and may hit the filesystem or a metadata
+# server, so their results are shared across reruns; the short ttl lets a fixed
+# setup be picked up without restarting the app
+@st.cache_resource(ttl=60, show_spinner=False)
+def _has_bedrock_credentials() -> bool:
+    import boto3
+
+    return bool(boto3.Session().get_credentials())
+
+
+@st.cache_resource(ttl=60, show_spinner=False)
+def _has_vertex_credentials() -> bool:
+    import google.auth
+    from google.auth.exceptions import DefaultCredentialsError
+
+    try:
+        google.auth.default(
+            scopes=["https://www.googleapis.com/auth/cloud-platform"],
+        )
+    except DefaultCredentialsError:
+        return False
+    return True
+
+
 def load_from_storage(filename: str) -> str | None:
     """Load data from a file in the storage directory."""
     try:
         file_path = CONFIG_DIR / filename
         if file_path.exists():
-            data = file_path.read_text().strip()
-            if data:
-                return data
+            return _read_storage(file_path, file_path.stat().st_mtime_ns)
     except Exception as e:
         st.write(f"Debug: Error loading {filename}: {e}")
     return None
 
 
+@lru_cache(maxsize=32)
+def _read_storage(file_path: PosixPath, mtime_ns: int) -> str | None:
+    """
+    Read a storage file once per version; every new session would otherwise hit
+    the disk again. Keying on the mtime picks up writes from save_to_storage and
+    edits made outside the app.
+    """
+    data = file_path.read_text().strip()
+    return data or None
+
+
 def save_to_storage(filename: str, data: str) -> None:
     """Save data to a file in the storage directory."""
     try:
         CONFIG_DIR.mkdir(parents=True, exist_ok=True)
         file_path = CONFIG_DIR / filename
-        file_path.write_text(data)
-        # Ensure only user can read/write the file
-        file_path.chmod(0o600)
+        # Create the file readable by the user only, rather than chmod'ing it after
+        # it was written, and swap it in whole so readers never see a partial file
+        tmp_path = file_path.with_name(f".{filename}.tmp")
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, file_path)
     except Exception as e:
         st.write(f"Debug: Error saving {filename}: {e}")
 
 
+def save_setting(filename: str, data: str) -> None:
+    """Save a setting unless storage already holds the same value."""
+    if data.strip() != (load_from_storage(filename) or ""):
+        save_to_storage(filename, data)
+
+
 def _api_response_callback(
     request: httpx.Request,
     response: httpx.Response | object | None,
     error: Exception | None,
     *,  # Force keyword arguments
     tab: DeltaGenerator,
-    response_state: dict[str, Any],  # Changed type hint to be more flexible
+    response_state: dict[int, ApiExchange],
 ):
-    """Handle an API response by storing it to state and rendering it."""
-    response_id = datetime.now().isoformat()
+    """
+    Handle an API response by storing it to state and rendering it. Only the
+    formatted text is kept, so the request and response objects can be freed.
+    """
     if isinstance(response, httpx.Response):
-        response_state[response_id] = response
-        _render_api_response(request, response, response_id, tab)
+        response_id = next(st.session_state.response_counter)
+        exchange = _format_api_response(request, response)
+        response_state[response_id] = exchange
+        _cleanup_old_responses(response_state)
+        _render_api_response(exchange, response_id, tab)
     elif error:
         with tab:
             st.error(f"API Error: {error}")
 
 
 def _tool_output_callback(
-    tool_output: ToolResult, tool_id: str, tool_state: dict[str, ToolResult]
+    tool_output: ToolResult,
+    tool_id: str,
+    tool_state: dict[str, ToolResult],
+    mouse_overlay: DeltaGenerator | None = None,
 ):
     """Handle a tool output by storing it to state and rendering it."""
+    _tool_outputs_callback(
+        [(tool_output, tool_id)], tool_state=tool_state, mouse_overlay=mouse_overlay
+    )
+
+
+def _tool_outputs_callback(
+    tool_outputs: list[tuple[ToolResult, str]],
+    tool_state: dict[str, ToolResult],
+    mouse_overlay: DeltaGenerator | None = None,
+):
+    """
+    Handle one turn's tool outputs, storing and rendering each of them. The mouse
+    overlay is updated once for the whole batch.
+    """
+    move = None
+    clicked = False
+    for tool_output, tool_id in tool_outputs:
+        _store_tool_result(tool_state, tool_id, tool_output)
+        _render_message(Sender.TOOL, tool_output)
+
+        output = tool_output.output
+        if not output:
+            continue
+        # Track the latest mouse movement
+        move = CLICLICK_MOVE_RE.search(output) or move
+        # Note any click; "c:" also covers rc:, dc: and mc:
+        clicked = clicked or "c:" in output
+
+    if not (move or clicked):
+        return
+    previous = st.session_state.mouse_event
+    x, y = (int(move[1]), int(move[2])) if move else (previous["x"], previous["y"])
+    st.session_state.mouse_event = {
+        "x": x,
+        "y": y,
+        "click": clicked,
+        "seq": previous["seq"] + 1,
+    }
+    if mouse_overlay is not None:
+        _render_mouse_overlay(mouse_overlay)
+
+
+def _render_mouse_overlay(slot: DeltaGenerator):
+    """
+    Send the latest mouse event to the overlay component. Rendering into the same
+    slot hands new props to the component already on the page.
+    """
+    with slot:
+        _mouse_overlay_component(**st.session_state.mouse_event, default=None)
+
+
+def _store_tool_result(
+    tool_state: dict[str, ToolResult], tool_id: str, tool_output: ToolResult
+):
+    """
+    Store a tool result, keeping screenshots only for the most recent
+    MAX_STORED_TOOL_IMAGES results; older ones keep their text but drop the image.
+    Past MAX_STORED_TOOL_RESULTS, the oldest results are dropped altogether.
+    """
+    tool_ids = st.session_state.tool_ids
     tool_state[tool_id] = tool_output
-    _render_message(Sender.TOOL, tool_output)
-
-    # Update mouse tracker for mouse movements
-    if hasattr(tool_output, "output") and "cliclick m:" in str(tool_output.output):
-        coords = str(tool_output.output).split("m:")[1].strip().split(",")
-        if len(coords) == 2:
-            html(f"""
-                <script>
-                    window.streamlitFunctions.updateMousePosition({coords[0]}, {coords[1]});
-                </script>
-            """)
-
-    # Show click animation for clicks
-    if hasattr(tool_output, "output") and any(
-        cmd in str(tool_output.output) for cmd in ["c:", "rc:", "dc:", "mc:"]
-    ):
-        # Get current mouse position from tracker
-        html("""
-            <script>
-                const tracker = document.getElementById('mouse-tracker');
-                if (tracker) {
-                    window.streamlitFunctions.createClickAnimation(
-                        parseInt(tracker.style.left),
-                        parseInt(tracker.style.top)
-                    );
-                }
-            </script>
-        """)
+    tool_ids.append(tool_id)
+    if len(tool_ids) > MAX_STORED_TOOL_IMAGES:
+        old_id = tool_ids[-MAX_STORED_TOOL_IMAGES - 1]
+        old_output = tool_state.get(old_id)
+        if old_output is not None and old_output.base64_image:
+            tool_state[old_id] = old_output.replace(base64_image=None)
+    while len(tool_ids) > MAX_STORED_TOOL_RESULTS:
+        tool_state.pop(tool_ids.popleft(), None)
 
 
 def _render_api_response(
-    request: httpx.Request,
-    response: httpx.Response,
-    response_id: str,
+    exchange: ApiExchange,
+    response_id: int,
     tab: DeltaGenerator,
 ):
     """Render an API response to a streamlit tab"""
     with tab:
-        with st.expander(f"Request/Response ({response_id})"):
-            newline = "\\n\\n"
-            st.markdown(
-                f"`{request.method} {request.url}`{newline}{newline.join(f'`{k}: {v}`' for k, v in request.headers.items())}"
-            )
-            st.json(request.read().decode())
-            st.markdown(
-                f"`{response.status_code}`{newline}{newline.join(f'`{k}: {v}`' for k, v in response.headers.items())}"
-            )
-            st.json(response.text)
+        _render_api_exchange(exchange, response_id)
+
+
+def _render_api_exchange(exchange: ApiExchange, response_id: int):
+    with st.expander(f"Request/Response (#{response_id})"):
+        st.markdown(exchange.request_headers)
+        _render_api_body(exchange.request_body, exchange.request_body_clipped)
+        st.markdown(exchange.response_headers)
+        if exchange.response_body is None:
+            # streamed responses are consumed by the SDK as they arrive
+            st.markdown("`(streamed response body not retained)`")
+        else:
+            _render_api_body(exchange.response_body, exchange.response_body_clipped)
+
+
+def _render_api_body(body: str, clipped: bool):
+    if clipped:
+        # a clipped body no longer parses, so show it as text
+        st.code(body, language="json")
+    else:
+        st.json(body)
+
+
+def _format_api_response(
+    request: httpx.Request, response: httpx.Response
+) -> ApiExchange:
+    """
+    Build the markdown and JSON text shown for an exchange. An exchange never changes
+    once recorded, so this runs once, when the response arrives.
+    """
+    newline = "\\n\\n"
+    request_headers = f"`{request.method} {request.url}`{newline}{newline.join(f'`{k}: {v}`' for k, v in request.headers.items())}"
+    response_headers = f"`{response.status_code}`{newline}{newline.join(f'`{k}: {v}`' for k, v in response.headers.items())}"
+    request_body, request_body_clipped = _clip_api_body(request.read())
+    try:
+        response_body, response_body_clipped = _clip_api_body(response.content)
+    except httpx.ResponseNotRead:
+        response_body, response_body_clipped = None, False
+    return ApiExchange(
+        request_headers,
+        request_body,
+        response_headers,
+        response_body,
+        request_body_clipped,
+        response_body_clipped,
+    )
+
+
+def _clip_api_body(body: bytes) -> tuple[str, bool]:
+    """
+    Decode at most LOG_BODY_LIMIT bytes of a body for display. Requests carry the
+    whole conversation, screenshots included, so they can run to megabytes.
+    """
+    if len(body) <= LOG_BODY_LIMIT:
+        return body.decode(errors="replace"), False
+    text = body[:LOG_BODY_LIMIT].decode(errors="replace")
+    return f"{text}\n... ({len(body) - LOG_BODY_LIMIT} more bytes)", True
 
 
 def _render_message(
@@ -500,7 +764,33 @@ def _render_message(
     message: str | dict | BetaToolUseBlock | ToolResult | BetaTextBlock,
 ):
     """Convert input from the user or output from the agent to a streamlit message."""
-    # Log messages with content
+    _log_message(sender, message)
+    if not message:
+        return
+    with st.chat_message(sender):
+        _render_message_body(message)
+
+
+def _render_messages(
+    sender: Sender,
+    messages: list[str | dict | BetaToolUseBlock | ToolResult | BetaTextBlock],
+):
+    """Render the blocks of one turn from a sender together, in a single chat message."""
+    for message in messages:
+        _log_message(sender, message)
+    messages = [message for message in messages if message]
+    if not messages:
+        return
+    with st.chat_message(sender):
+        for message in messages:
+            _render_message_body(message)
+
+
+def _log_message(
+    sender: Sender,
+    message: str | dict | BetaToolUseBlock | ToolResult | BetaTextBlock,
+):
+    """Log a message as it is rendered."""
     if isinstance(message, dict) and message.get("type") == "tool_use" and message.get("name") == "bash":
         cmd = message.get("input", {}).get("command", "")
         log_tool_use(sender, "bash", cmd)
@@ -520,112 +810,199 @@ def _render_message(
             if text:
                 log_message(sender, "text", text)  # Log the actual text
             else:
-                log_message(sender, "text", str(message))  # Fallback to full dict
+                # Log the block type and tool name only; str() of the whole
+                # block serializes tool inputs even when DEBUG is disabled
+                log_message(sender, message.get("type", "dict"), message.get("name"))
         elif isinstance(message, BetaTextBlock):
             log_message(sender, "text", message.text)  # Log the actual text
         else:
-            log_message(sender, "text", str(message))  # Convert anything else to string
+            log_message(sender, type(message).__name__, getattr(message, "name", None))
 
-    if not message:
-        return
 
-    is_tool_result = not isinstance(message, str) and (
-        isinstance(message, ToolResult)
-        or message.__class__.__name__ == "ToolResult"
-        or message.__class__.__name__ == "CLIResult"
-        or message.__class__.__name__ == "ToolFailure"
-    )
+def _render_message_body(
+    message: str | dict | BetaToolUseBlock | ToolResult | BetaTextBlock,
+):
+    """Write a single message into the current chat message container."""
+    render = _BODY_RENDERERS.get(type(message))
+    if render is None:
+        # remember the choice so later messages of this type skip the checks
+        render = _BODY_RENDERERS[type(message)] = _body_renderer_for(message)
+    render(message)
 
-    with st.chat_message(sender):
-        if is_tool_result:
-            message = cast(ToolResult, message)
-            if message.output:
-                # Truncate long outputs
-                truncated_output = truncate_message_content(message.output)
-                if message.__class__.__name__ == "CLIResult":
-                    st.code(truncated_output)
-                else:
-                    st.markdown(truncated_output)
-            if message.error:
-                st.error(message.error)
-            if message.base64_image and not st.session_state.hide_images:
-                try:
-                    st.image(base64.b64decode(message.base64_image))
-                except Exception:
-                    st.error("Failed to load image")
-        elif isinstance(message, BetaToolUseBlock) or isinstance(message, ToolUseBlock):
-            st.code(f"Tool Use: {message.name}\nInput: {message.input}")
-        elif isinstance(message, dict):
-            if message.get("type") == "text":
-                text = message.get("text", "")
-                if "<thinking>" in text and "</thinking>" in text:
-                    parts = text.split("<thinking>")
-                    pre_thinking = parts[0]
-                    thinking_and_post = parts[1].split("</thinking>")
-                    thinking = thinking_and_post[0]
-                    post_thinking = thinking_and_post[1] if len(thinking_and_post) > 1 else ""
-                    
-                    if pre_thinking.strip():
-                        st.markdown(pre_thinking)
-                    with st.expander("Thinking...", expanded=True):
-                        st.markdown(thinking)
-                    if post_thinking.strip():
-                        st.markdown(post_thinking)
-                else:
-                    st.markdown(text)
-            elif message.get("type") == "tool_use":
-                if message.get("name") == "bash":
-                    command = message.get("input", {}).get("command", "")
-                    st.code(f"Tool Use: bash\nInput: {command}")
-                elif message.get("name") == "computer":
-                    input_data = message.get("input", {})
-                    action = input_data.get("action", "")
-                    text = input_data.get("text", "")
-                    coordinate = input_data.get("coordinate", "")
-                    
-                    input_str = f"action: {action}"
-                    if text:
-                        input_str += f", text: {text}"
-                    if coordinate:
-                        input_str += f", coordinate: {coordinate}"
-                    
-                    st.code(f"Tool Use: computer\nInput: {input_str}")
-                elif message.get("name") == "str_replace_editor":
-                    input_data = message.get("input", {})
-                    params = []
-                    if 'command' in input_data:
-                        params.append(f"command: {input_data['command']}")
-                    if 'path' in input_data:
-                        params.append(f"path: {input_data['path']}")
-                    if 'file_text' in input_data:
-                        params.append(f"text: {input_data['file_text']}")
-                    
-                    input_str = ", ".join(params) if params else "{}"
-                    st.code(f"Tool Use: str_replace_editor\nInput: {input_str}")
-                else:
-                    st.code(f"Tool Use: {message.get('name')}\nInput: {json.dumps(message.get('input', {}), indent=2)}")
-            else:
-                text_content = message.get("text", "")
-                if text_content:
-                    st.markdown(text_content)
-                else:
-                    st.markdown(str(message))
-        elif isinstance(message, BetaTextBlock):
-            st.markdown(message.text)
+
+def _body_renderer_for(message: object) -> Callable[[Any], None]:
+    """
+    Pick a renderer for a type missing from _BODY_RENDERERS: a subclass, or a tool
+    result class from a reloaded copy of the tools module, hence the name check.
+    """
+    if isinstance(message, ToolResult) or type(message).__name__ in TOOL_RESULT_TYPE_NAMES:
+        return _render_tool_result_body
+    if isinstance(message, (BetaToolUseBlock, ToolUseBlock)):
+        return _render_tool_use_block_body
+    if isinstance(message, dict):
+        return _render_dict_body
+    if isinstance(message, BetaTextBlock):
+        return _render_text_block_body
+    return _render_fallback_body
+
+
+def _render_tool_result_body(message: ToolResult):
+    if message.output:
+        # Truncate long outputs
+        truncated_output = truncate_message_content(message.output)
+        if type(message).__name__ == "CLIResult":
+            st.code(truncated_output)
+        else:
+            st.markdown(truncated_output)
+    if message.error:
+        st.error(message.error)
+    if message.base64_image and not st.session_state.hide_images:
+        try:
+            st.image(_image_thumbnail(message.base64_image))
+        except Exception:
+            st.error("Failed to load image")
+
+
+def _render_tool_use_block_body(message: BetaToolUseBlock | ToolUseBlock):
+    st.code(f"Tool Use: {message.name}\nInput: {message.input}")
+
+
+def _render_dict_body(message: dict):
+    if message.get("type") == "text":
+        text = message.get("text", "")
+        thinking_parts = _split_thinking(text)
+        if thinking_parts:
+            pre_thinking, thinking, post_thinking = thinking_parts
+            if pre_thinking.strip():
+                st.markdown(pre_thinking)
+            with st.expander("Thinking...", expanded=True):
+                st.markdown(thinking)
+            if post_thinking.strip():
+                st.markdown(post_thinking)
+        else:
+            st.markdown(text)
+    elif message.get("type") == "tool_use":
+        st.code(_tool_use_text(message))
+    else:
+        text_content = message.get("text", "")
+        if text_content:
+            st.markdown(text_content)
         else:
             st.markdown(str(message))
 
 
+@lru_cache(maxsize=256)
+def _split_thinking(text: str) -> tuple[str, str, str] | None:
+    """
+    Split text around its first <thinking> section, once per text; reruns pass the
+    same string object from session state. None if it has no thinking section.
+    """
+    match = THINKING_RE.match(text)
+    return match.groups() if match else None
+
+
+def _render_text_block_body(message: BetaTextBlock):
+    st.markdown(message.text)
+
+
+def _render_fallback_body(message: object):
+    st.markdown(str(message))
+
+
+# Body renderer per concrete message type, so a render is a single dict lookup
+_BODY_RENDERERS: dict[type, Callable[[Any], None]] = {
+    str: _render_fallback_body,
+    dict: _render_dict_body,
+    ToolResult: _render_tool_result_body,
+    CLIResult: _render_tool_result_body,
+    ToolFailure: _render_tool_result_body,
+    BetaToolUseBlock: _render_tool_use_block_body,
+    ToolUseBlock: _render_tool_use_block_body,
+    BetaTextBlock: _render_text_block_body,
+}
+
+
+def _tool_use_text(message: dict) -> str:
+    """
+    Describe a tool_use block, reusing the text from earlier reruns; tool_use ids
+    are unique, so the id alone identifies the block.
+    """
+    tool_use_id = message.get("id")
+    text = _TOOL_USE_TEXT.get(tool_use_id)
+    if text is not None:
+        _TOOL_USE_TEXT.move_to_end(tool_use_id)
+        return text
+    text = _format_tool_use(message)
+    if tool_use_id is not None:
+        _TOOL_USE_TEXT[tool_use_id] = text
+        if len(_TOOL_USE_TEXT) > MAX_CACHED_TOOL_USE_TEXT:
+            _TOOL_USE_TEXT.popitem(last=False)
+    return text
+
+
+def _format_tool_use(message: dict) -> str:
+    if message.get("name") == "bash":
+        command = message.get("input", {}).get("command", "")
+        return f"Tool Use: bash\nInput: {command}"
+    elif message.get("name") == "computer":
+        input_data = message.get("input", {})
+        action = input_data.get("action", "")
+        text = input_data.get("text", "")
+        coordinate = input_data.get("coordinate", "")
+
+        input_str = f"action: {action}"
+        if text:
+            input_str += f", text: {text}"
+        if coordinate:
+            input_str += f", coordinate: {coordinate}"
+
+        return f"Tool Use: computer\nInput: {input_str}"
+    elif message.get("name") == "str_replace_editor":
+        input_data = message.get("input", {})
+        params = []
+        if 'command' in input_data:
+            params.append(f"command: {input_data['command']}")
+        if 'path' in input_data:
+            params.append(f"path: {input_data['path']}")
+        if 'file_text' in input_data:
+            params.append(f"text: {input_data['file_text']}")
+
+        input_str = ", ".join(params) if params else "{}"
+        return f"Tool Use: str_replace_editor\nInput: {input_str}"
+    else:
+        input_json = orjson.dumps(message.get('input', {}), option=orjson.OPT_INDENT_2)
+        return f"Tool Use: {message.get('name')}\nInput: {input_json.decode()}"
+
+
+@lru_cache(maxsize=64)
+def _image_thumbnail(base64_image: str) -> bytes:
+    """
+    Decode a screenshot once and shrink it to a WebP no wider than the chat needs.
+    Reruns pass the same string object from session state, whose hash is cached,
+    so a hit costs no more than a dict lookup.
+    """
+    img = Image.open(BytesIO(base64.b64decode(base64_image)))
+    img.thumbnail(THUMBNAIL_SIZE)
+    output = BytesIO()
+    img.save(output, format="WEBP", quality=80, method=4)
+    return output.getvalue()
+
+
 def maybe_add_interruption_blocks():
     if not st.session_state.in_sampling_loop:
         return []
     result = []
     last_message = st.session_state.messages[-1]
-    previous_tool_use_ids = [
-        block["id"] for block in last_message["content"] if block["type"] == "tool_use"
-    ]
+    # only an assistant turn can hold tool calls still waiting for their results
+    previous_tool_use_ids = []
+    if last_message["role"] == Sender.BOT and isinstance(last_message["content"], list):
+        previous_tool_use_ids = [
+            block["id"] for block in last_message["content"] if block["type"] == "tool_use"
+        ]
     for tool_use_id in previous_tool_use_ids:
-        st.session_state.tools[tool_use_id] = ToolResult(error=INTERRUPT_TOOL_ERROR)
+        _store_tool_result(
+            st.session_state.tools, tool_use_id, ToolResult(error=INTERRUPT_TOOL_ERROR)
+        )
         result.append(
             BetaToolResultBlockParam(
                 tool_use_id=tool_use_id,
@@ -675,10 +1052,16 @@ def _cleanup_old_responses(response_state: dict):
 
 def truncate_message_content(content: str, max_lines: int = 5) -> str:
     """Truncate message content to max_lines, adding '...' if truncated"""
-    lines = content.splitlines()
-    if len(lines) > max_lines:
-        return "\n".join(lines[:max_lines]) + "\n..."
-    return content
+    # Find the end of the last kept line instead of splitting the whole output,
+    # which can be many KB for shell results
+    end = -1
+    for _ in range(max_lines):
+        end = content.find("\n", end + 1)
+        if end == -1:
+            return content
+    if end == len(content) - 1:
+        return content
+    return content[:end] + "\n..."
 
 
 def _cleanup_old_messages():
@@ -725,29 +1108,26 @@ def render_chat_history(messages):
     return html(html_string)
 
 
-def debounce(wait):
+def throttle(wait):
     """
-    Decorator to debounce rapid UI updates
+    Decorator to throttle rapid UI updates: calls within `wait` seconds of the
+    last one that ran are dropped. Uses the monotonic clock, which wall clock
+    adjustments cannot move backwards.
     """
     def decorator(fn):
-        last_timestamp = 0
-        
+        last_timestamp = float("-inf")
+
         @wraps(fn)
-        def debounced(*args, **kwargs):
+        def throttled(*args, **kwargs):
             nonlocal last_timestamp
-            current_time = time.time()
-            
-            if current_time - last_timestamp > wait:
+            current_time = time.monotonic()
+
+            if current_time - last_timestamp >= wait:
                 last_timestamp = current_time
                 return fn(*args, **kwargs)
-        return debounced
+        return throttled
     return decorator
 
-@debounce(0.1)  # 100ms debounce
-def update_chat_ui(messages):
-    # Update UI logic here
-    pass
-
 
 from dataclasses import dataclass
 from typing import List, Optional
@@ -833,8 +1213,9 @@ def load_optimized_css():
     </style>
     """
 
-# Apply the optimized CSS
-st.markdown(load_optimized_css(), unsafe_allow_html=True)
+# Everything main() injects into the page, joined once so each rerun sends a
+# single element
+PAGE_STYLE = STREAMLIT_STYLE + load_optimized_css()
 
 
 def render_visible_messages(messages):
@@ -1,4 +1,4 @@
-from .base import CLIResult, ToolResult
+from .base import CLIResult, ToolFailure, ToolResult
 from .bash import BashTool
 from .collection import ToolCollection
 from .computer import ComputerTool
@@ -10,5 +10,6 @@ __ALL__ = [
     ComputerTool,
     EditTool,
     ToolCollection,
+    ToolFailure,
     ToolResult,
 ]
@@ -16,7 +16,7 @@ class _BashSession:
     _process: asyncio.subprocess.Process
 
     command: str = "/bin/bash"
-    _output_delay: float = 0.2  # seconds
+    _read_size: int = 64 * 1024  # bytes
     _timeout: float = 120.0  # seconds
     _sentinel: str = "<<exit>>"
 
@@ -67,24 +67,21 @@ class _BashSession:
         assert self._process.stdout
         assert self._process.stderr
 
-        # send command to the process
+        # send command to the process; the sentinel is echoed to both streams so
+        # each can be read up to the end of this command's output
         self._process.stdin.write(
-            command.encode() + f"; echo '{self._sentinel}'\n".encode()
+            command.encode()
+            + f"; echo '{self._sentinel}'; echo '{self._sentinel}' >&2\n".encode()
         )
         await self._process.stdin.drain()
 
         # read output from the process, until the sentinel is found
         try:
             async with asyncio.timeout(self._timeout):
-                while True:
-                    await asyncio.sleep(self._output_delay)
-                    # if we read directly from stdout/stderr, it will wait forever for
-                    # EOF. use the StreamReader buffer directly instead.
-                    output = self._process.stdout._buffer.decode()  # pyright: ignore[reportAttributeAccessIssue]
-                    if self._sentinel in output:
-                        # strip the sentinel and break
-                        output = output[: output.index(self._sentinel)]
-                        break
+                output, error = await asyncio.gather(
+                    self._read_until_sentinel(self._process.stdout),
+                    self._read_until_sentinel(self._process.stderr),
+                )
         except asyncio.TimeoutError:
             self._timed_out = True
             raise ToolError(
@@ -94,16 +91,31 @@ class _BashSession:
         if output.endswith("\n"):
             output = output[:-1]
 
-        error = self._process.stderr._buffer.decode()  # pyright: ignore[reportAttributeAccessIssue]
         if error.endswith("\n"):
             error = error[:-1]
 
-        # clear the buffers so that the next output can be read correctly
-        self._process.stdout._buffer.clear()  # pyright: ignore[reportAttributeAccessIssue]
-        self._process.stderr._buffer.clear()  # pyright: ignore[reportAttributeAccessIssue]
-
         return CLIResult(output=output, error=error)
 
+    async def _read_until_sentinel(self, stream: asyncio.StreamReader) -> str:
+        """
+        Read from a stream until the sentinel, returning everything before it. Reads
+        return as soon as any output arrives, so there is no polling delay.
+        """
+        sentinel = self._sentinel.encode()
+        buffer = bytearray()
+        while True:
+            # only the tail can hold a sentinel split across two reads
+            start = max(0, len(buffer) - len(sentinel) + 1)
+            chunk = await stream.read(self._read_size)
+            if not chunk:
+                # bash exited; the next run reports it
+                return buffer.decode(errors="replace")
+            buffer += chunk
+            index = buffer.find(sentinel, start)
+            if index != -1:
+                # drop the sentinel and the newline echoed after it
+                return buffer[:index].decode(errors="replace")
+
 
 class BashTool(BaseAnthropicTool):
     """
@@ -126,8 +138,7 @@ class BashTool(BaseAnthropicTool):
         self, command: str | None = None, restart: bool = False, **kwargs
     ):
         if restart:
-            if self._session:
-                self._session.stop()
+            self._stop_session()
             self._session = _BashSession()
             await self._session.start()
 
@@ -142,6 +153,11 @@ class BashTool(BaseAnthropicTool):
 
         raise ToolError("no command provided.")
 
+    def _stop_session(self):
+        if self._session:
+            self._session.stop()
+            self._session = None
+
     def to_params(self) -> BetaToolBash20241022Param:
         return {
             "type": self.api_type,
@@ -163,9 +179,10 @@ class BashTool(BaseAnthropicTool):
 
         for attempt in range(self.MAX_RETRIES):
             try:
-                # Run command with timeout
-                _, stdout, stderr = await asyncio.wait_for(
-                    run(command),
+                # Run command with timeout in the long-lived shell, which
+                # saves spawning a new bash for every command
+                result = await asyncio.wait_for(
+                    self(command=command),
                     timeout=self.DEFAULT_TIMEOUT
                 )
                 
@@ -176,11 +193,11 @@ class BashTool(BaseAnthropicTool):
                         'event_type': 'TOOL_RESULT',
                         'sender': 'bash',
                         'result_type': 'success',
-                        'output': stdout if stdout else stderr
+                        'output': result.output if result.output else result.error
                     }
                 )
                 
-                return ToolResult(output=stdout, error=stderr)
+                return result
 
             except asyncio.TimeoutError:
                 error_msg = f"Command timed out after {self.DEFAULT_TIMEOUT}s (attempt {attempt + 1}/{self.MAX_RETRIES})"
@@ -199,6 +216,8 @@ class BashTool(BaseAnthropicTool):
                     )
                     return ToolResult(error=error_msg)
                     
+                # The shell is still busy with the command; start a fresh one
+                self._stop_session()
                 # Kill any hanging processes before retry
                 await run("pkill -f " + command.split()[0])
                 await asyncio.sleep(1)  # Brief pause between retries
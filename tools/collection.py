@@ -1,5 +1,7 @@
 """Collection classes for managing multiple tools."""
 
+import asyncio
+import inspect
 from typing import Any
 
 from anthropic.types.beta import BetaToolUnionParam
@@ -29,6 +31,9 @@ class ToolCollection:
         if not tool:
             return ToolFailure(error=f"Tool {name} is invalid")
         try:
-            return await tool(**tool_input)
+            if inspect.iscoroutinefunction(tool.__call__):
+                return await tool(**tool_input)
+            # keep a synchronous tool's blocking work off the event loop
+            return await asyncio.to_thread(tool, **tool_input)
         except ToolError as e:
             return ToolFailure(error=e.message)
@@ -312,10 +312,11 @@ class ComputerTool(BaseAnthropicTool):
                 return result
 
             if path.exists():
-                # Read the image and compress if necessary
-                image_data = path.read_bytes()
+                # Read the image and compress if necessary, in a worker thread
+                # so other tool calls keep running meanwhile
+                image_data = await asyncio.to_thread(path.read_bytes)
                 if len(image_data) > MAX_IMAGE_SIZE:
-                    image_data = compress_image(image_data)
+                    image_data = await asyncio.to_thread(compress_image, image_data)
 
                 return ToolResult(base64_image=base64.b64encode(image_data).decode())
             return ToolResult(error="Screenshot file was not created")